@@ -1,195 +1,437 @@
 import requests
+import atexit
 import json
-import time
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
 import logging
+import logging.handlers
+from itertools import filterfalse, islice
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import NamedTuple
 from datetime import datetime
-from requests.exceptions import RequestException, Timeout, HTTPError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, HTTPError, ChunkedEncodingError
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from urllib3.util import Retry
+
+try:
+    import orjson  # Optional: C-accelerated JSON parser (pip install orjson)
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # NEW: Setup Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('pipeline.log'),  # Main log file
-        logging.StreamHandler()  # Console
-    ]
-)
-error_logger = logging.getLogger('errors')
-error_handler = logging.FileHandler('error.log')
+# Callers only enqueue records; a background QueueListener does the file/console I/O
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler('pipeline.log')  # Main log file
+file_handler.setFormatter(log_formatter)
+console_handler = logging.StreamHandler()  # Console
+console_handler.setFormatter(log_formatter)
+error_handler = logging.FileHandler('error.log')  # Errors only
 error_handler.setLevel(logging.ERROR)
-error_logger.addHandler(error_handler)
+error_handler.setFormatter(log_formatter)
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.handlers.MemoryHandler(capacity=1024, target=file_handler),  # Buffered; flushes when full, on ERROR, at exit
+    console_handler,
+    error_handler,
+    respect_handler_level=True
+)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 
-def fetch_products(max_retries=3, timeout=10):
+class RawProduct(NamedTuple):
     """
-    Fetches raw products with error handling and logging.
+    Cleaned API product (rating flattened); tuple-backed, so no per-row __dict__.
     """
+    id: int
+    title: str
+    price: float
+    description: str
+    category: str
+    image: str
+    rate: float
+    count: int
+
+class TransformedProduct(NamedTuple):
+    """
+    Row for the products table; field order matches PRODUCT_COLUMNS so it binds as-is.
+    """
+    product_id: int
+    name: str
+    price_usd: float
+    desc: str
+    category_norm: str
+    image_url: str
+    avg_rating: float
+    review_count: int
+    price_inr: float
+    is_expensive: bool
+    total_value_inr: float
+
+# Shared HTTP session: keep-alive connection pool; retries with exponential backoff live on the adapter
+# (connect errors, timeouts before the response arrives, and 429/5xx statuses)
+MAX_RETRIES = 3
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = 'etl/1.0'
+SESSION.mount('https://', HTTPAdapter(
+    pool_maxsize=10,
+    max_retries=Retry(total=MAX_RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+def _get_json(url, timeout=10):
     logger = logging.getLogger('fetch')
-    url = "https://fakestoreapi.com/products"
-    products = []
-    
-    for attempt in range(max_retries):
+    for attempt in range(MAX_RETRIES + 1):
+        response = SESSION.get(url, timeout=timeout, stream=True)
         try:
-            logger.info(f"Fetching (attempt {attempt + 1}/{max_retries})...")
-            response = requests.get(url, timeout=timeout)
             response.raise_for_status()
-            
-            data = response.json()
-            if not isinstance(data, list):
-                raise ValueError("Bad response format")
-            
-            for product in data:
-                cleaned = {
-                    'id': product.get('id', None),
-                    'title': product.get('title', 'Unknown'),
-                    'price': product.get('price', 0.0),
-                    'description': product.get('description', ''),
-                    'category': product.get('category', 'Unknown'),
-                    'image': product.get('image', ''),
-                    'rating': product.get('rating', {'rate': 0.0, 'count': 0})
-                }
-                if cleaned['id'] is None or cleaned['title'] == 'Unknown':
-                    logger.warning(f"Skipping invalid product: {product}")
-                    continue
-                products.append(cleaned)
-            
-            logger.info(f"Raw fetch: {len(products)} products.")
-            return products
-            
-        except Timeout:
-            logger.warning(f"Timeout—retrying...")
-        except HTTPError as e:
-            logger.error(f"HTTP error: {e}—retrying...")
-        except RequestException as e:
-            logger.error(f"Request failed: {e}—retrying...")
-        except (ValueError, KeyError) as e:
-            logger.error(f"Parse error: {e}")
-            raise  # Re-raise to fail the pipeline
-        
-        if attempt < max_retries - 1:
+        except HTTPError:
+            response.close()  # Streamed body is never read; return the connection to the pool
+            raise
+        # The body is read after urllib3's Retry has returned, so a timeout or dropped
+        # connection mid-download is retried here with the same backoff
+        try:
+            content = response.content
+            break
+        except (RequestsConnectionError, ChunkedEncodingError) as e:
+            response.close()
+            if attempt == MAX_RETRIES:
+                raise
             wait = 2 ** attempt
-            logger.info(f"Wait {wait}s...")
+            logger.warning("Reading response failed: %s—retrying in %ds...", e, wait)
             time.sleep(wait)
-        else:
-            logger.error("All retries failed.")
-            raise RequestException("Fetch failed after all retries")
+    # Parse the raw bytes directly: skips requests' charset detection and str decode
+    return _json_loads(content)
+
+def fetch_many(urls, timeout=10, max_workers=10):
+    """
+    Fetches several endpoints concurrently over the shared session; results keep input order.
+    """
+    if not urls:
+        return []
+    if len(urls) == 1:
+        return [_get_json(urls[0], timeout)]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as pool:
+        return list(pool.map(lambda url: _get_json(url, timeout), urls))
+
+def fetch_products(timeout=10):
+    """
+    Fetches raw products with error handling and logging.
+    """
+    logger = logging.getLogger('fetch')
+    url = "https://fakestoreapi.com/products"
+    products = []
     
-    return products
+    try:
+        logger.info("Fetching (up to %d retries)...", MAX_RETRIES)
+        data, = fetch_many([url], timeout)
+        if not isinstance(data, list):
+            raise ValueError("Bad response format")
+        
+        for product in data:
+            # Validate before touching the rating so one bad row is skipped, not fatal
+            product_id = product.get('id', None)
+            title = product.get('title', 'Unknown')
+            rating = product.get('rating') or {'rate': 0.0, 'count': 0}
+            if product_id is None or title == 'Unknown' or not isinstance(rating, dict):
+                logger.warning("Skipping invalid product: %s", product)
+                continue
+            products.append(RawProduct(
+                id=product_id,
+                title=title,
+                price=product.get('price', 0.0),
+                description=product.get('description', ''),
+                category=product.get('category', 'Unknown'),
+                image=product.get('image', ''),
+                rate=rating.get('rate', 0.0),
+                count=rating.get('count', 0)
+            ))
+        
+        logger.info("Raw fetch: %d products.", len(products))
+        return products
+        
+    except (ValueError, KeyError) as e:
+        logger.error("Parse error: %s", e)
+        raise  # Re-raise to fail the pipeline
+    except HTTPError as e:
+        logger.error("HTTP error: %s", e)
+        raise
+    except RequestException as e:
+        logger.error("Fetch failed after all retries: %s", e)
+        raise
+
+_CATEGORY_POSSESSIVE_RE = re.compile(r"(men|women)'s")
+
+@lru_cache(maxsize=256)
+def _normalize_category(category):
+    """
+    "Men's Clothing" -> "mens clothing"; memoized since the API has only a handful of categories.
+    """
+    return _CATEGORY_POSSESSIVE_RE.sub(r"\1s", category.lower())
 
 def transform_products(products, usd_to_inr=83):
     """
     Transforms data with logging.
     """
+    transformed = list(iter_transformed(products, usd_to_inr))
+    _report_transformed(len(transformed), len(products))
+    return transformed
+
+def _report_transformed(transformed_count, raw_count):
+    """
+    Logs the transform summary; fails the run when nothing survived. Shared by
+    transform_products and run_pipeline.
+    """
+    logging.getLogger('transform').info("Transformed: %d products (from %d raw).", transformed_count, raw_count)
+    if not transformed_count:
+        raise ValueError("No products after transformation")
+
+MIN_PRICE_USD = 50
+MIN_RATING = 3.0
+
+def _is_filtered_out(product):
+    return product.price < MIN_PRICE_USD or product.rate < MIN_RATING
+
+def iter_transformed(products, usd_to_inr=83):
+    """
+    Lazily filters and enriches products; shared by transform_products and the pipeline stage.
+    """
     logger = logging.getLogger('transform')
-    transformed = []
-    for product in products:
-        trans = {
-            'product_id': product['id'],
-            'name': product['title'],
-            'price_usd': product['price'],
-            'desc': product['description'][:100] + '...' if len(product['description']) > 100 else product['description'],
-            'category_norm': product['category'].lower().replace("men's", "mens").replace("women's", "womens"),
-            'image_url': product['image'],
-            'avg_rating': product['rating']['rate'],
-            'review_count': product['rating']['count']
-        }
-        
-        if trans['price_usd'] < 50 or trans['avg_rating'] < 3.0:
-            logger.info(f"Filtering out: {trans['name']} (price: ${trans['price_usd']}, rating: {trans['avg_rating']})")
-            continue
-        
-        trans['price_inr'] = round(trans['price_usd'] * usd_to_inr, 2)
-        trans['is_expensive'] = trans['price_usd'] > 100
-        trans['total_value_inr'] = round(trans['price_inr'] * (1 + trans['avg_rating'] / 10), 2)
-        
-        transformed.append(trans)
+    if logger.isEnabledFor(logging.INFO):
+        def filtered_out(product):
+            if _is_filtered_out(product):
+                logger.info("Filtering out: %s (price: $%s, rating: %s)", product.title, product.price, product.rate)
+                return True
+            return False
+    else:
+        filtered_out = _is_filtered_out  # Chosen once: no per-row level check when quiet
     
-    logger.info(f"Transformed: {len(transformed)} products (from {len(products)} raw).")
-    if not transformed:
-        raise ValueError("No products after transformation")
-    return transformed
+    # Filter first so rejected rows skip the string work below
+    for product in filterfalse(filtered_out, products):
+        price_usd = product.price
+        avg_rating = product.rate
+        description = product.description
+        price_inr = round(price_usd * usd_to_inr, 2)
+        yield TransformedProduct(
+            product_id=product.id,
+            name=product.title,
+            price_usd=price_usd,
+            desc=description[:100] + '...' if len(description) > 100 else description,
+            category_norm=_normalize_category(product.category),
+            image_url=product.image,
+            avg_rating=avg_rating,
+            review_count=product.count,
+            price_inr=price_inr,
+            is_expensive=price_usd > 100,
+            total_value_inr=round(price_inr * (1 + avg_rating / 10), 2)
+        )
+
+PRODUCT_COLUMNS = TransformedProduct._fields
+# Bound parameters per statement (SQLITE_MAX_VARIABLE_NUMBER) limits rows per multi-row INSERT
+SQLITE_MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+INSERT_BATCH_ROWS = min(500, SQLITE_MAX_VARIABLES // len(PRODUCT_COLUMNS))
+INSERT_LOG_SQL = 'INSERT INTO logs (timestamp, status, message) VALUES (?, ?, ?)'
+# Secondary indexes for reporting queries on the transform's filter columns
+PRODUCT_INDEXES = (
+    ('idx_products_cat', 'category_norm'),
+    ('idx_products_price', 'price_usd')
+)
+
+@lru_cache(maxsize=32)
+def _insert_products_sql(verb, n_rows):
+    """
+    Builds the multi-row INSERT once per (verb, row count); the identical string then hits
+    the connection's prepared-statement cache instead of being re-parsed.
+    """
+    row_placeholders = '(' + ', '.join('?' * len(PRODUCT_COLUMNS)) + ')'
+    return f"{verb} INTO products ({', '.join(PRODUCT_COLUMNS)}) VALUES {', '.join([row_placeholders] * n_rows)}"
+
+def chunked(iterable, n):
+    """
+    Yields lists of up to n items from iterable.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+def open_db(db_file='products.db'):
+    """
+    Opens the pipeline's SQLite connection (tuned for the bulk write path) and creates
+    the logs/products tables. One connection is shared by store_to_db and log_run_status.
+    """
+    # isolation_level=None: no implicit transactions, BEGIN/COMMIT are issued explicitly
+    conn = sqlite3.connect(db_file, cached_statements=256, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')  # No rollback-journal rewrite per commit
+    conn.execute('PRAGMA synchronous=NORMAL')  # Crash-safe in WAL mode; no fsync per commit
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')  # ~20 MB page cache
+    
+    # Create logs table if not exists
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS logs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            status TEXT NOT NULL,
+            message TEXT
+        )
+    ''')
+    
+    # Existing products table creation...
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            product_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            price_usd REAL NOT NULL,
+            desc TEXT,
+            category_norm TEXT,
+            image_url TEXT,
+            avg_rating REAL,
+            review_count INTEGER,
+            price_inr REAL,
+            is_expensive BOOLEAN,
+            total_value_inr REAL
+        )
+    ''')
+    return conn
 
-def store_to_db(transformed_products, db_file='products.db'):
+def store_to_db(conn, transformed_products, full_rebuild=False):
     """
-    Stores to SQLite with logging; creates logs table.
+    Stores to SQLite with logging; transformed_products may be any iterable (consumed in
+    INSERT_BATCH_ROWS chunks). Returns the number of rows written.
+    full_rebuild empties the table first and uses plain INSERT (no conflict handling needed).
     """
     logger = logging.getLogger('store')
     try:
-        conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
         
-        # Create logs table if not exists
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS logs (
-                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT NOT NULL,
-                status TEXT NOT NULL,
-                message TEXT
+        # Single transaction for the whole batch (one journal sync instead of one per row);
+        # multi-row VALUES so each statement carries up to INSERT_BATCH_ROWS products
+        insert_verb = 'INSERT' if full_rebuild else 'INSERT OR REPLACE'
+        conn.execute('BEGIN')
+        if full_rebuild:
+            # Drop indexes so the reload doesn't maintain them row by row; rebuilt below in one pass
+            for index_name, _ in PRODUCT_INDEXES:
+                cursor.execute(f'DROP INDEX IF EXISTS {index_name}')
+            cursor.execute('DELETE FROM products')
+        changes_before = conn.total_changes
+        for chunk in chunked(transformed_products, INSERT_BATCH_ROWS):
+            cursor.execute(
+                _insert_products_sql(insert_verb, len(chunk)),
+                [value for row in chunk for value in row]
             )
-        ''')
-        
-        # Existing products table creation...
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                product_id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                price_usd REAL NOT NULL,
-                desc TEXT,
-                category_norm TEXT,
-                image_url TEXT,
-                avg_rating REAL,
-                review_count INTEGER,
-                price_inr REAL,
-                is_expensive BOOLEAN,
-                total_value_inr REAL
-            )
-        ''')
-        
-        for product in transformed_products:
-            cursor.execute('''
-                INSERT OR REPLACE INTO products 
-                (product_id, name, price_usd, desc, category_norm, image_url, avg_rating, review_count, 
-                 price_inr, is_expensive, total_value_inr)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                product['product_id'], product['name'], product['price_usd'], product['desc'],
-                product['category_norm'], product['image_url'], product['avg_rating'], product['review_count'],
-                product['price_inr'], product['is_expensive'], product['total_value_inr']
-            ))
-        
+        stored = conn.total_changes - changes_before  # Rows written, without re-querying the table
+        for index_name, column in PRODUCT_INDEXES:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON products({column})')
         conn.commit()
-        cursor.execute('SELECT COUNT(*) FROM products')
-        count = cursor.fetchone()[0]
-        logger.info(f"Stored/Updated {len(transformed_products)} products in {db_file}. Total records: {count}")
+        logger.info("Stored/Updated %d products.", stored)
         
-        # Sample preview
-        cursor.execute('SELECT name, price_usd, price_inr FROM products LIMIT 3')
-        for row in cursor.fetchall():
-            logger.info(f"Sample: {row[0]}: ${row[1]} USD / ₹{row[2]} INR")
+        # Table count + sample preview cost extra queries; only with ETL_DEBUG set
+        if os.environ.get('ETL_DEBUG'):
+            cursor.execute('SELECT COUNT(*) FROM products')
+            logger.info("Total records: %d", cursor.fetchone()[0])
+            cursor.execute('SELECT name, price_usd, price_inr FROM products LIMIT 3')
+            for row in cursor.fetchall():
+                logger.info("Sample: %s: $%s USD / ₹%s INR", *row)
+        return stored
         
     except sqlite3.Error as e:
-        logger.error(f"DB Error: {e}")
+        logger.error("DB Error: %s", e)
         raise
     finally:
-        conn.close()
+        if conn.in_transaction:  # Failed mid-batch (DB error or the input iterable raised)
+            conn.rollback()
+
+def _drain(q):
+    """
+    Yields items from q until the None sentinel. The sentinel is put back so a second
+    drain (e.g. cleanup after a failure) returns immediately instead of blocking.
+    """
+    while True:
+        item = q.get()
+        if item is None:
+            q.put(None)
+            return
+        yield item
+
+def run_pipeline(conn, usd_to_inr=83, full_rebuild=False, queue_size=2000):
+    """
+    Runs fetch → transform → store as concurrent stages linked by bounded queues:
+    fetcher and transformer threads feed the DB writer on the calling thread (which owns conn).
+    Transform and store overlap; fetch is still batch (the whole response is downloaded and
+    parsed before the first product is queued). Returns (fetched, transformed) counts.
+    """
+    raw_q, clean_q = queue.Queue(queue_size), queue.Queue(queue_size)
+    errors = []
+    fetched = [0]
+    transformed = [0]
+    
+    def fetcher():
+        try:
+            for product in fetch_products():  # List of the parsed response, not a stream
+                raw_q.put(product)
+                fetched[0] += 1
+        except Exception as e:
+            errors.append(e)
+        finally:
+            raw_q.put(None)
+    
+    def transformer():
+        try:
+            for trans in iter_transformed(_drain(raw_q), usd_to_inr):
+                clean_q.put(trans)
+        except Exception as e:
+            errors.append(e)
+            for _ in _drain(raw_q):  # Keep the fetcher from blocking on a full queue
+                pass
+        finally:
+            clean_q.put(None)
+    
+    def rows():
+        for trans in _drain(clean_q):
+            transformed[0] += 1
+            yield trans
+        # Raised inside store_to_db's transaction, so nothing is committed. The clean-queue
+        # sentinel is only sent after the fetcher finished, so both counts are final here.
+        if errors:
+            raise errors[0]
+        _report_transformed(transformed[0], fetched[0])
+    
+    threads = [
+        threading.Thread(target=fetcher, name='etl-fetch', daemon=True),
+        threading.Thread(target=transformer, name='etl-transform', daemon=True)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        store_to_db(conn, rows(), full_rebuild=full_rebuild)
+    finally:
+        for _ in _drain(clean_q):  # Writer failed early: unblock the upstream stages
+            pass
+        for thread in threads:
+            thread.join()
+    return fetched[0], transformed[0]
 
-def log_run_status(status, message, db_file='products.db'):
+def log_run_status(conn, status, message):
     """
     NEW: Log run to DB (tracks last successful time).
     """
-    timestamp = datetime.now().isoformat()
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO logs (timestamp, status, message) VALUES (?, ?, ?)',
-            (timestamp, status, message)
-        )
-        conn.commit()
-        conn.close()
-        logging.info(f"Run logged: {status} - {message}")
+        conn.execute(INSERT_LOG_SQL, (datetime.now().isoformat(), status, message))  # Autocommits
+        logging.info("Run logged: %s - %s", status, message)
     except sqlite3.Error as e:
-        logging.error(f"Failed to log run: {e}")
+        logging.error("Failed to log run: %s", e)
 
 # BONUS: Optional Email Alert on Failure (uncomment & configure)
 # import smtplib
@@ -208,22 +450,16 @@ if __name__ == "__main__":
     run_start = datetime.now().isoformat()
     status = "FAILED"
     message = ""
+    conn = None
     try:
         logging.info("Pipeline started.")
-        raw_products = fetch_products()
-        if raw_products:
-            transformed_products = transform_products(raw_products)
-            if transformed_products:
-                store_to_db(transformed_products)
-                status = "SUCCESS"
-                message = f"Fetched {len(raw_products)}, transformed {len(transformed_products)}, stored OK. Last success: {run_start}"
-            else:
-                message = "Transformation failed: No products left."
-        else:
-            message = "Fetch failed: No raw products."
+        conn = open_db('products.db')  # Inside the try so DB open failures hit the crash handler
+        fetched, transformed = run_pipeline(conn)
+        status = "SUCCESS"
+        message = f"Fetched {fetched}, transformed {transformed}, stored OK. Last success: {run_start}"
         
         print(f"\nPipeline Status: {status}")
-        log_run_status(status, message)
+        log_run_status(conn, status, message)
         
         # BONUS: Email on failure (uncomment)
         # if status == "FAILED":
@@ -232,11 +468,14 @@ if __name__ == "__main__":
     except Exception as e:
         error_msg = f"Pipeline crashed: {str(e)}"
         logging.error(error_msg)
-        error_logger.error(error_msg)
         print(f"\nPipeline Status: FAILED - {error_msg}")
-        log_run_status(status, error_msg)
+        if conn is not None:
+            log_run_status(conn, status, error_msg)
         
         # BONUS: Email
         # send_alert_email(error_msg)
         
-        raise  # Optional: Re-raise for CI/CD
\ No newline at end of file
+        raise  # Optional: Re-raise for CI/CD
+    finally:
+        if conn is not None:
+            conn.close()
\ No newline at end of file